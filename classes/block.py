@@ -1,22 +1,103 @@
 import collections
+import functools
 
 import numpy as np
 import scipy.optimize
 
-from ..util import functions as f
 from ..util import constants
 
 from .primitives import Vertex
 
-class DeferredFunction:
-    """ stores a function and its variables to be used at a later time """
-    def __init__(self, callable, *args, **kwargs):
-        self.callable = callable
-        self.args = args
-        self.kwargs = kwargs
-    
-    def call(self):
-        return self.callable(*self.args, **self.kwargs)
+try:
+    # optional: jit-compile the grading root-find, which is pure
+    # scalar arithmetic and is called for every graded block axis
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        def decorator(function):
+            return function
+        return decorator
+
+@njit(cache=True)
+def _grading_residual(g, n_cells, block_size, cell_size):
+    """ how much the last cell of a geometric series of n_cells cells
+    with ratio g, scaled to sum up to block_size, misses cell_size;
+    last = g^(n-1) * block_size * (g - 1)/(g^n - 1)
+    (when g = 1 all cells are simply block_size/n) """
+    if abs(g - 1) < constants.tol:
+        return cell_size - block_size/n_cells
+
+    if g > 1:
+        # equivalent form that cannot overflow for large g
+        last = block_size*(1 - 1/g)/(1 - g**(-n_cells))
+    else:
+        last = block_size*(g**n_cells - g**(n_cells - 1))/(g**n_cells - 1)
+
+    return cell_size - last
+
+@njit(cache=True)
+def _solve_grading(n_cells, block_size, cell_size):
+    """ finds the cell-to-cell expansion ratio g so that the last cell of
+    a geometric series of n_cells cells that sum up to block_size
+    is exactly cell_size; returns nan when not converged """
+    if n_cells == 1:
+        # a single cell spans the whole block; also, the derivative
+        # below is exactly 0 for n_cells = 1
+        return 1.0
+
+    # most blocks are graded only mildly so the residual is nearly
+    # linear around g = 1; a single cheap secant step from the flanks
+    # of 1 lands close to the root, then Newton with the analytic
+    # derivative converges quadratically
+    g_0 = 1.0
+    g_1 = 1.001
+    f_0 = _grading_residual(g_0, n_cells, block_size, cell_size)
+    f_1 = _grading_residual(g_1, n_cells, block_size, cell_size)
+
+    g = g_0
+    if f_1 != f_0:
+        g = g_1 - f_1*(g_1 - g_0)/(f_1 - f_0)
+    if g <= 0:
+        # a wild secant step; start Newton from 1 instead
+        g = g_0
+
+    for _ in range(20):
+        residual = _grading_residual(g, n_cells, block_size, cell_size)
+
+        if abs(g - 1) < constants.tol:
+            # limit of the derivative below for g -> 1
+            derivative = -block_size*(n_cells - 1)/(2*n_cells)
+        elif g > 1:
+            # everything scaled by g^(-n_cells), like in
+            # _grading_residual, so that large g cannot overflow
+            u = 1 - 1/g
+            v = 1 - g**(-n_cells)
+            du = (n_cells - (n_cells - 1)/g)/g
+            dv = n_cells/g
+
+            derivative = -block_size*(du*v - u*dv)/v**2
+        else:
+            u = g**n_cells - g**(n_cells - 1)
+            v = g**n_cells - 1
+            du = n_cells*g**(n_cells - 1) - (n_cells - 1)*g**(n_cells - 2)
+            dv = n_cells*g**(n_cells - 1)
+
+            derivative = -block_size*(du*v - u*dv)/v**2
+
+        step = residual/derivative
+        g -= step
+
+        if g <= 0:
+            return np.nan # diverged
+
+        if abs(step) < constants.tol:
+            return g
+
+    return np.nan # not converged
+
+# pre-warm the (possible) jit compilation at import time so that
+# the first graded block doesn't pay for it
+_solve_grading(2, 1.0, 0.5)
 
 class Block():
     """ a direct representation of a blockMesh block;
@@ -35,9 +116,25 @@ class Block():
 
     # pairs of vertices (index in block.vertices) along axes
     axis_pair_indexes = (
-        ([0, 1], [3, 2], [4, 5], [7, 6]), # x
-        ([0, 3], [1, 2], [5, 6], [4, 7]), # y
-        ([0, 4], [1, 5], [2, 6], [3, 7]), # z
+        ((0, 1), (3, 2), (4, 5), (7, 6)), # x
+        ((0, 3), (1, 2), (5, 6), (4, 7)), # y
+        ((0, 4), (1, 5), (2, 6), (3, 7)), # z
+    )
+
+    # the same pairs as frozensets, ready to be used as edge_map
+    # keys without constructing a set per lookup
+    _axis_pair_sets = tuple(
+        tuple(frozenset(pair) for pair in axis_pairs)
+        for axis_pairs in axis_pair_indexes
+    )
+
+    # the same pairs again, split into two (3, 4) index arrays
+    # for vectorized gathering of vertices' mesh_indexes
+    _axis_pair_starts = np.array(
+        [[pair[0] for pair in axis_pairs] for axis_pairs in axis_pair_indexes]
+    )
+    _axis_pair_ends = np.array(
+        [[pair[1] for pair in axis_pairs] for axis_pairs in axis_pair_indexes]
     )
 
     def __init__(self, vertices, edges):
@@ -68,6 +165,27 @@ class Block():
 
         # set in Mesh.prepare_data()
         self.mesh_index = None
+
+        # per-axis cache of vertex pairs; built lazily in
+        # get_axis_vertex_pairs() and dropped when mesh_index changes
+        self._axis_pairs_cache = [None, None, None]
+
+        # memoized get_axis_from_pair() answers; count/grading
+        # propagation asks about the same pairs over and over
+        self._axis_from_pair_cache = { }
+
+        # vertices' mesh_indexes as an int array and per-side face
+        # indexes; precomputed in update_mesh_indexes() so that
+        # format_face() doesn't traverse Vertex objects
+        self._mesh_idx = None
+        self._face_idx = None
+
+        # per-axis cache of block size; get_size() assumes geometry
+        # does not change anymore once sizes are queried
+        # (Mesh.prepare_data() only assigns indexes); anything that
+        # moves vertices or swaps edges afterwards must call
+        # invalidate_size_cache()
+        self._size_cache = [None, None, None]
         
         # functions like count_to_size and some other
         # can only run after mesh.prepare_data() has been
@@ -75,30 +193,41 @@ class Block():
         self.deferred_counts = []
         self.deferred_gradings = []
 
+    # explicit short-circuited tests instead of all()/any();
+    # these properties are hit in tight loops during count/grading
+    # propagation in Mesh.prepare_data()
     @property
     def is_count_defined(self):
-        return all(self.n_cells)
-    
+        n = self.n_cells
+        return n[0] is not None and n[1] is not None and n[2] is not None
+
     @property
     def is_any_count_defined(self):
-        return any(self.n_cells)
-    
+        n = self.n_cells
+        return n[0] is not None or n[1] is not None or n[2] is not None
+
     @property
     def is_grading_defined(self):
-        return all(self.grading)
+        g = self.grading
+        return g[0] is not None and g[1] is not None and g[2] is not None
 
     @property
     def is_any_grading_defined(self):
-        return any(self.grading)
+        g = self.grading
+        return g[0] is not None or g[1] is not None or g[2] is not None
 
 
     @classmethod
-    def create_from_points(cls, points, edges=[]):
+    def create_from_points(cls, points, edges=None):
         """ create a block from a raw list of 8 points;
         edges are optional; edge's 2 vertex indexes refer to
         block.vertices list (0 - 7) """
+        # mutable default argument would be shared between calls
+        if edges is None:
+            edges = []
+
         block = cls(
-            [Vertex(p) for p in points],
+            [Vertex(p) for p in np.asarray(points, dtype=float)],
             edges
         )
 
@@ -125,56 +254,108 @@ class Block():
         # returns an approximate block dimensions:
         # if an edge is defined, use the edge.get_length(),
         # otherwise simply distance between two points
-        def find_edge(index_1, index_2):
-            for e in self.edges:
-                if {e.block_index_1, e.block_index_2} == {index_1, index_2}:
-                    return e
-            return None
-
-        def vertex_distance(index_1, index_2):
-            return f.norm(
-                self.vertices[index_1].point - self.vertices[index_2].point
-            )
-    
-        def block_size(index_1, index_2):
-            edge = find_edge(index_1, index_2)
-            if edge:
-                return edge.get_length()
+        if self._size_cache[axis] is not None:
+            return self._size_cache[axis]
+
+        edge_map = {
+            frozenset((e.block_index_1, e.block_index_2)): e
+            for e in self.edges
+        }
 
-            return vertex_distance(index_1, index_2)
-        
         sum_edges = 0
-        for pair in self.axis_pair_indexes[axis]:
-            sum_edges += block_size(pair[0], pair[1])
-        
-        return sum_edges/4
+        straight_pairs = [] # pairs without an edge: just distance between points
+
+        for pair, pair_set in zip(self.axis_pair_indexes[axis], self._axis_pair_sets[axis]):
+            edge = edge_map.get(pair_set)
+            if edge:
+                sum_edges += edge.get_length()
+            else:
+                straight_pairs.append(pair)
+
+        if straight_pairs:
+            # one vectorized norm over all straight pairs instead of
+            # a python loop with a small allocation per pair
+            points = np.stack([v.point for v in self.vertices])
+            indexes_1 = [pair[0] for pair in straight_pairs]
+            indexes_2 = [pair[1] for pair in straight_pairs]
+
+            sum_edges += np.linalg.norm(
+                points[indexes_1] - points[indexes_2], axis=1
+            ).sum()
+
+        self._size_cache[axis] = sum_edges/4
+
+        return self._size_cache[axis]
+
+    def invalidate_size_cache(self):
+        """ drops cached block sizes; must be called whenever
+        vertices are moved or edges changed after get_size() was used """
+        self._size_cache = [None, None, None]
 
     def get_axis_vertex_pairs(self, axis):
         """ returns 4 pairs of Vertex.mesh_indexes along given axis """
-        pairs = []
-
-        for pair in self.axis_pair_indexes[axis]:
-            # TEST
-            if self.vertices[pair[0]].mesh_index == self.vertices[pair[1]].mesh_index:
-                # omit vertices in the same spot; there is no edge anyway
-                # (wedges and pyramids)
-                continue
-
-            pairs.append({
-                self.vertices[pair[0]].mesh_index,
-                self.vertices[pair[1]].mesh_index
-            })
-        
+        if self._axis_pairs_cache[axis] is not None:
+            return self._axis_pairs_cache[axis]
+
+        if self._mesh_idx is not None:
+            mesh_idx = self._mesh_idx
+        else:
+            # not yet through Mesh.prepare_data()
+            mesh_idx = np.fromiter(
+                (v.mesh_index for v in self.vertices), dtype=np.int64, count=8
+            )
+
+        starts = mesh_idx[self._axis_pair_starts[axis]]
+        ends = mesh_idx[self._axis_pair_ends[axis]]
+
+        # omit vertices in the same spot; there is no edge anyway
+        # (wedges and pyramids)
+        keep = np.nonzero(starts != ends)[0]
+
+        pairs = tuple(
+            frozenset((int(starts[i]), int(ends[i]))) for i in keep
+        )
+
+        self._axis_pairs_cache[axis] = pairs
+
         return pairs
 
     def get_axis_from_pair(self, pair):
         """ returns axis index from a given pair of vertices;
         returns None if this block does not have an edge between given pair """
+        pair = frozenset(pair)
+
+        if pair in self._axis_from_pair_cache:
+            return self._axis_from_pair_cache[pair]
+
+        axis = None
+
         for i in range(3):
-            if set(pair) in self.get_axis_vertex_pairs(i):
-                return i
-        
-        return None
+            if pair in self.get_axis_vertex_pairs(i):
+                axis = i
+                break
+
+        self._axis_from_pair_cache[pair] = axis
+
+        return axis
+
+    def invalidate_axis_cache(self):
+        """ drops cached vertex pairs; must be called whenever
+        vertices' mesh_indexes change (Mesh.prepare_data()) """
+        self._axis_pairs_cache = [None, None, None]
+        self._axis_from_pair_cache = { }
+
+    def update_mesh_indexes(self):
+        """ precomputes vertices' mesh_indexes per face for fast
+        formatting; called after Mesh.prepare_data() assigned them """
+        self._mesh_idx = np.fromiter(
+            (v.mesh_index for v in self.vertices), dtype=np.int64, count=8
+        )
+
+        self._face_idx = {
+            side: self._mesh_idx[list(indexes)]
+            for side, indexes in self.face_map.items()
+        }
 
     ###
     ### Manipulation
@@ -184,19 +365,25 @@ class Block():
         to a chosen patch name """
         # see patches: an example in __init__()
 
-        if type(sides) == str:
-            sides = [sides]
+        if isinstance(sides, str):
+            sides = (sides, )
 
         if patch_name not in self.patches:
             self.patches[patch_name] = []
-        
-        self.patches[patch_name] += sides
+
+        # skip sides that are already assigned so that repeated calls
+        # don't produce duplicated faces in blockMeshDict
+        assigned = self.patches[patch_name]
+        assigned.extend(s for s in sides if s not in assigned)
     
     def count_to_size(self, axis, cell_size):
         """ Takes the average length of all edges of the block along given axis
         and sets the number of cells to obtain the desired cell size. """
-        df = DeferredFunction(self._count_to_size, axis, cell_size)
-        self.deferred_counts.append(df)
+        # functools.partial calls straight into C, with no python-level
+        # attribute lookups or kwargs unpacking at resolve time
+        self.deferred_counts.append(
+            functools.partial(self._count_to_size, axis, cell_size)
+        )
 
     def _count_to_size(self, axis, cell_size):
         block_size = self.get_size(axis)
@@ -208,8 +395,9 @@ class Block():
     def grade_to_size(self, axis, cell_size, inverse=False):
         """ Calculate grading for given axis so that first cell will be of cell_size;
         If a negative cell_size is given, the last cell size is being set. """
-        df = DeferredFunction(self._grade_to_size, axis, cell_size, inverse)
-        self.deferred_gradings.append(df)
+        self.deferred_gradings.append(
+            functools.partial(self._grade_to_size, axis, cell_size, inverse)
+        )
 
     def _grade_to_size(self, axis, cell_size, inverse=False):
         # calculate grading so that first cell will be of cell_size
@@ -217,69 +405,57 @@ class Block():
         n_cells = self.n_cells[axis]
         block_size = self.get_size(axis)
 
-        if abs(cell_size) > block_size:
-            raise AssertionError(f"Cell size is larger than block size: {abs(cell_size)} > {block_size}")
-
-        cell_sizes = []
-
-        def fcell_size(grading):
-            nonlocal cell_sizes
-
-            cell_sizes = [1] # will be scaled later
-
-            # returns last cell size for given grading;
-            # scales everything so that block size matches the original
-            l_block = 0
-
-            for _ in range(n_cells):
-                l_block += cell_sizes[-1]
-                cell_sizes.append(cell_sizes[-1]*grading)
-
-                if cell_sizes[-1] < constants.tol:
-                    return
-            
-            cell_sizes = [c*block_size/l_block for c in cell_sizes]
-
-            return cell_size - cell_sizes[-1]
+        # the last of n > 1 positive cells is always strictly smaller
+        # than the block, so cell_size == block_size has no solution
+        # either; reject it along with oversized cells
+        # (a single cell spanning the whole block is fine)
+        if abs(cell_size) >= block_size and n_cells > 1:
+            raise AssertionError(f"Cell size is not smaller than block size: {abs(cell_size)} >= {block_size}")
 
         # find a grading that produces correct last_cell_size
-        scipy.optimize.newton(fcell_size, 1)
+        g = _solve_grading(n_cells, block_size, cell_size)
+
+        if np.isnan(g):
+            # secant/newton diverged (an extremely graded block);
+            # fall back to a robust bracketing solver
+            g = scipy.optimize.brentq(
+                _grading_residual, 1e-6, 1e6,
+                args=(n_cells, block_size, cell_size)
+            )
 
         if inverse:
-            self.grading[axis] = cell_sizes[-1]/cell_sizes[0]
+            self.grading[axis] = g**(n_cells - 1)
         else:
-            self.grading[axis] = cell_sizes[0]/cell_sizes[-1]
+            self.grading[axis] = g**(-(n_cells - 1))
 
     ###
     ### Output/formatting
     ###
     def format_face(self, side):
-        indexes = self.face_map[side]
-        vertices = np.take(self.vertices, indexes)
-
-        return "({} {} {} {})".format(
-            vertices[0].mesh_index,
-            vertices[1].mesh_index,
-            vertices[2].mesh_index,
-            vertices[3].mesh_index
+        if self._face_idx is not None:
+            return "({} {} {} {})".format(*self._face_idx[side])
+
+        # fallback for blocks not yet put through Mesh.prepare_data()
+        i_0, i_1, i_2, i_3 = self.face_map[side]
+        vertices = self.vertices
+
+        return (
+            f"({vertices[i_0].mesh_index} {vertices[i_1].mesh_index} "
+            f"{vertices[i_2].mesh_index} {vertices[i_3].mesh_index})"
         )
     
     def __repr__(self):
         """ outputs block's definition for blockMeshDict file """
-        # hex definition
-        output = "hex "
-        # vertices
-        output += " ( " + " ".join(str(v.mesh_index) for v in self.vertices) + " ) "
-    
-        # cellZone
-        output += self.cell_zone
-        # number of cells
-        output += f" ({self.n_cells[0]} {self.n_cells[1]} {self.n_cells[2]}) "
+        # a single format pass instead of a cascade of
+        # string concatenations
+        vertex_ids = " ".join(str(v.mesh_index) for v in self.vertices)
+        n = self.n_cells
         # grading: use 1 if not defined
-        grading = [self.grading[i] if self.grading[i] is not None else 1 for i in range(3)]
-        output += f" simpleGrading ({grading[0]} {grading[1]} {grading[2]})"
+        g_0, g_1, g_2 = (g if g is not None else 1 for g in self.grading)
 
-        # add a comment with block index
-        output += f" // {self.mesh_index} {self.description}"
-
-        return output
+        return (
+            f"hex  ( {vertex_ids} ) {self.cell_zone}" # hex definition, vertices, cellZone
+            f" ({n[0]} {n[1]} {n[2]}) " # number of cells
+            f" simpleGrading ({g_0} {g_1} {g_2})"
+            f" // {self.mesh_index} {self.description}" # a comment with block index
+        )
@@ -3,6 +3,8 @@ import numpy as np
 from ..util import functions as g
 from ..util import constants, tools
 
+from .block import Block
+
 class Mesh():
     """ contains blocks, edges and all necessary methods for assembling blockMeshDict """
     def __init__(self):
@@ -10,6 +12,11 @@ class Mesh():
         self.edges = [] # list of edges
         self.blocks = [] # list of blocks
 
+        # a contiguous (N, 3) array of all vertex coordinates,
+        # built in prepare_data(); Vertex.point then reads from here
+        # so that geometric operations work on one block of memory
+        self.points = None
+
     def find_vertex(self, new_vertex):
         """ checks if any of existing vertices in self.vertices are
         in the same location as the passed one; if so, returns
@@ -109,6 +116,50 @@ class Mesh():
 
         return False
 
+    def _precompute_block_sizes(self):
+        """ primes all blocks' size caches in a single vectorized pass
+        instead of letting every deferred count/grading compute its own
+        block's size separately; axes with curved edges are left to
+        Block.get_size()'s exact per-edge path """
+        if not self.blocks:
+            return
+
+        # an (M, 8, 3) tensor of corner points of all blocks
+        corner_indexes = np.array(
+            [[v.mesh_index for v in block.vertices] for block in self.blocks]
+        )
+        points = self.points[corner_indexes]
+
+        # vertex pairs along all axes, flattened to an (12,) index pair
+        pairs = np.array(Block.axis_pair_indexes)
+        indexes_1 = pairs[:, :, 0].ravel()
+        indexes_2 = pairs[:, :, 1].ravel()
+
+        # sizes[m, axis]: mean distance between the 4 vertex pairs
+        distances = np.linalg.norm(
+            points[:, indexes_1] - points[:, indexes_2], axis=-1
+        )
+        sizes = distances.reshape(len(self.blocks), 3, 4).mean(axis=-1)
+
+        for m, block in enumerate(self.blocks):
+            edge_pairs = {
+                frozenset((e.block_index_1, e.block_index_2))
+                for e in block.edges
+            }
+
+            for axis in range(3):
+                if block._size_cache[axis] is not None:
+                    continue
+
+                if any(
+                    pair_set in edge_pairs
+                    for pair_set in Block._axis_pair_sets[axis]
+                ):
+                    # this axis needs edge lengths; don't prime it
+                    continue
+
+                block._size_cache[axis] = sizes[m, axis]
+
     def prepare_data(self):
         # collect all vertices from all blocks,
         # check for duplicates and give them indexes
@@ -121,7 +172,17 @@ class Mesh():
                     self.vertices.append(block_vertex)
                 else:
                     block.vertices[i] = found_vertex
-        
+
+            # mesh_indexes are now assigned; any cached vertex pairs are stale
+            block.invalidate_axis_cache()
+            block.update_mesh_indexes()
+
+        # move all coordinates to a single contiguous array;
+        # vertices keep only an index into it
+        self.points = np.array([vertex.point for vertex in self.vertices])
+        for vertex in self.vertices:
+            vertex._mesh_points = self.points
+
         # collect all edges from all blocks;
         for block in self.blocks:
             # check for duplicates (same vertex pairs) and
@@ -143,10 +204,14 @@ class Mesh():
                     # only non-existing edges are added
                     self.edges.append(block_edge)
 
+        # compute block sizes for all blocks at once so that
+        # deferred counts/gradings below find them ready
+        self._precompute_block_sizes()
+
         # now is the time to set counts
         for block in self.blocks:
             for f in block.deferred_counts:
-                f.call()
+                f()
 
         # propagate cell count:
         # a riddle similar to sudoku, keep traversing
@@ -182,7 +247,7 @@ class Mesh():
         # now is the time to set gradings
         for block in self.blocks:
             for f in block.deferred_gradings:
-                f.call()
+                f()
 
         # propagate grading:
         # very similar to counts
@@ -9,9 +9,21 @@ class Vertex():
     """ point with an index that's used in block and face definition
     and can output in OpenFOAM format """
     def __init__(self, point):
-        self.point = np.array(point)
+        self._point = np.asarray(point, dtype=float)
         self.mesh_index = None # will be changed in Mesh.prepare_data()
-        
+
+        # Mesh.prepare_data() gathers coordinates of all vertices into
+        # a single contiguous Mesh.points array and points this here;
+        # from then on self.point is a row of that array
+        self._mesh_points = None
+
+    @property
+    def point(self):
+        if self._mesh_points is None:
+            return self._point
+
+        return self._mesh_points[self.mesh_index]
+
     def __repr__(self):
         s = constants.vector_format(self.point)
         